@@ -0,0 +1,111 @@
+"""
+Serialization benchmark for the large list endpoints (print-jobs, cashflow,
+kasbon, employees). Compares FastAPI's default path (jsonable_encoder +
+json.dumps) with orjson, and bytes on the wire raw / gzip / brotli.
+Uses synthetic month-sized payloads, no database needed.
+Run manually: python benchmarks/bench_serialization.py [--repeat N]
+"""
+import sys
+import gzip
+import json
+import time
+import uuid
+import base64
+import random
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+random.seed(42)
+MONTH = "2025-11"
+MATERIALS = ["Vinyl", "Banner 280gr", "Sticker Chromo", "Art Paper 260", "Albatros", "Luster"]
+
+
+def day():
+    return f"{MONTH}-{random.randint(1, 30):02d}"
+
+
+def print_job():
+    mats = []
+    for _ in range(random.randint(1, 4)):
+        qty = random.randint(1, 25)
+        hn = random.choice([15000, 20000, 35000, 50000])
+        mats.append({"name": random.choice(MATERIALS), "quantity": qty, "unit": "pcs",
+                     "harga_normal": hn, "harga_diskon": None, "stock_id": str(uuid.uuid4()),
+                     "is_custom": False, "price_per_unit": hn, "dapat_diskon": False, "diskon_nominal": 0})
+    return {"id": str(uuid.uuid4()), "date": day(), "materials": mats,
+            "payment_method": random.choice(["cash", "transfer"]),
+            "total_price": sum(m["price_per_unit"] * m["quantity"] for m in mats),
+            "customer_name": "Pelanggan", "notes": "", "cashier": "Kasir", "cashier_id": str(uuid.uuid4()),
+            "created_at": f"{day()}T10:15:00.000000+00:00"}
+
+
+def cashflow():
+    return {"id": str(uuid.uuid4()), "type": random.choice(["income", "expense"]), "date": day(),
+            "amount": random.randint(10, 500) * 1000, "description": "Pembelian bahan", "notes": "",
+            "payment_method": "cash", "handled_by": "Admin", "employee_id": "",
+            "created_at": f"{day()}T09:00:00.000000+00:00"}
+
+
+def kasbon():
+    return {"id": str(uuid.uuid4()), "employee_id": str(uuid.uuid4()), "employee_name": "Karyawan",
+            "amount": random.randint(5, 50) * 10000, "payment_method": "cash", "notes": "",
+            "settled": False, "date": day(), "created_at": f"{day()}T08:00:00.000000+00:00"}
+
+
+def employee(photo_bytes):
+    return {"id": str(uuid.uuid4()), "name": "Karyawan", "whatsapp": "08123456789", "birthdate": "1995-01-01",
+            "birthplace": "Jakarta", "position": "Operator", "status_crew": "tetap", "monthly_salary": 3000000,
+            "work_hours_per_day": 8, "photo": "data:image/jpeg;base64," + base64.b64encode(photo_bytes).decode(),
+            "status": "active", "created_at": "2025-01-01T00:00:00+00:00"}
+
+
+PAYLOADS = {
+    "print-jobs (900/month)": [print_job() for _ in range(900)],
+    "cashflow (400/month)": [cashflow() for _ in range(400)],
+    "kasbon (120/month)": [kasbon() for _ in range(120)],
+    "employees (25, 40KB photo)": [employee(random.randbytes(40_000)) for _ in range(25)],
+}
+
+
+def default_render(payload):
+    # Same as FastAPI's JSONResponse path: jsonable_encoder then json.dumps
+    return json.dumps(jsonable_encoder(payload), ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def orjson_render(payload):
+    return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def timed(fn, payload, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = fn(payload)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, body
+
+
+def main():
+    repeat = int(sys.argv[sys.argv.index("--repeat") + 1]) if "--repeat" in sys.argv else 20
+    print(f"best of {repeat} runs\n")
+    print(f"{'payload':<28}{'default ms':>12}{'orjson ms':>12}{'speedup':>9}"
+          f"{'raw KB':>10}{'gzip KB':>10}{'br KB':>10}")
+    for name, payload in PAYLOADS.items():
+        default_ms, body = timed(default_render, payload, repeat)
+        orjson_ms, fast_body = timed(orjson_render, payload, repeat)
+        assert json.loads(body) == json.loads(fast_body)
+        gz = len(gzip.compress(fast_body, compresslevel=9))
+        br = f"{len(brotli.compress(fast_body, quality=4)) / 1024:>10.1f}" if brotli else f"{'n/a':>10}"
+        print(f"{name:<28}{default_ms:>12.2f}{orjson_ms:>12.2f}{default_ms / orjson_ms:>8.1f}x"
+              f"{len(fast_body) / 1024:>10.1f}{gz / 1024:>10.1f}{br}")
+
+
+if __name__ == "__main__":
+    main()
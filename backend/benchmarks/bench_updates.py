@@ -0,0 +1,67 @@
+"""
+Update round-trip benchmark: the old find_one -> update_one -> find_one
+handler pattern against a single find_one_and_update(return_document=AFTER).
+Needs a reachable MongoDB; writes to a throwaway database that is dropped
+afterwards. Latency is dominated by network round trips, so run it against
+the same deployment the API talks to.
+Run manually: MONGO_URL=mongodb://... python benchmarks/bench_updates.py [--repeat N]
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+import statistics
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+
+DB_NAME = f"bench_updates_{uuid.uuid4().hex[:8]}"
+DOCS = 200
+
+
+async def three_trips(coll, doc_id, n):
+    if not await coll.find_one({"id": doc_id}):
+        raise LookupError(doc_id)
+    await coll.update_one({"id": doc_id}, {"$set": {"quantity": n, "notes": f"edit {n}"}})
+    return await coll.find_one({"id": doc_id}, {"_id": 0})
+
+
+async def single_trip(coll, doc_id, n):
+    doc = await coll.find_one_and_update({"id": doc_id}, {"$set": {"quantity": n, "notes": f"edit {n}"}},
+                                         projection={"_id": 0}, return_document=ReturnDocument.AFTER)
+    if doc is None:
+        raise LookupError(doc_id)
+    return doc
+
+
+async def measure(fn, coll, ids, repeat):
+    samples = []
+    for n in range(repeat):
+        started = time.perf_counter()
+        await fn(coll, ids[n % len(ids)], n)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+async def main():
+    repeat = int(sys.argv[sys.argv.index("--repeat") + 1]) if "--repeat" in sys.argv else 500
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    coll = client[DB_NAME].stock
+    try:
+        ids = [str(uuid.uuid4()) for _ in range(DOCS)]
+        await coll.insert_many([{"id": i, "name": "Vinyl", "quantity": 100, "unit": "m", "notes": ""} for i in ids])
+        await coll.create_index("id", unique=True)
+        print(f"{repeat} updates against {DOCS} documents\n")
+        print(f"{'pattern':<34}{'p50 ms':>10}{'p95 ms':>10}")
+        for name, fn in (("find + update + find", three_trips), ("find_one_and_update(AFTER)", single_trip)):
+            p50, p95 = await measure(fn, coll, ids, repeat)
+            print(f"{name:<34}{p50:>10.2f}{p95:>10.2f}")
+    finally:
+        await client.drop_database(DB_NAME)
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
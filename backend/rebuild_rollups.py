@@ -0,0 +1,23 @@
+"""
+Recompute monthly_rollups from print_jobs, projects, cashflow and kasbon.
+Run manually: python rebuild_rollups.py [--check]
+  --check  only report drift between stored rollups and the raw data
+Uses backend .env (MONGO_URL, DB_NAME), same as server.py.
+"""
+import sys
+import asyncio
+
+from server import rebuild_monthly_rollups
+
+
+async def main():
+    apply = "--check" not in sys.argv[1:]
+    result = await rebuild_monthly_rollups(apply=apply)
+    for d in result["drift"]:
+        print(f"  {d['month']} {d['field']}: stored {d['stored']:,.0f}, expected {d['expected']:,.0f}")
+    print(f"{result['months']} month(s), {len(result['drift'])} drifted value(s).")
+    print("Rollups rebuilt." if apply else "Check only, nothing written.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
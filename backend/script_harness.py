@@ -0,0 +1,44 @@
+"""Shared setup for the manual test_*.py scripts that need MongoDB
+
+Import it before server: it points DB_NAME at a throwaway database named
+after the script, which run() drops again when the checks are done.
+Run a script manually: MONGO_URL=mongodb://... python test_<name>.py
+"""
+import os
+import sys
+import uuid
+import asyncio
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = f"{Path(sys.argv[0]).stem}_{uuid.uuid4().hex[:8]}"
+
+
+def check(name, passed):
+    print(f"{'✅' if passed else '❌'} {name}")
+    return passed
+
+
+def check_all(checks):
+    ok = True
+    for name, passed in checks:
+        ok = check(name, passed) and ok
+    return ok
+
+
+def run(main):
+    """Run the async main(), drop the throwaway database, exit 0 only if every check passed"""
+    import server
+
+    async def checked():
+        try:
+            return await main()
+        finally:
+            await server.client.drop_database(os.environ["DB_NAME"])
+            server.hash_executor.shutdown(wait=False)
+            server.notify_executor.shutdown(wait=False)
+
+    sys.exit(0 if asyncio.run(checked()) else 1)
@@ -0,0 +1,105 @@
+"""Test concurrent device registration against a real MongoDB
+
+Fires parallel register_device calls the way a fleet of tablets does on
+launch (same device twice, reinstall storms sharing one FCM token) and checks
+that the unique indexes leave exactly one row per device_id / fcm_token, that
+the reinstall precedence (device_id, then fcm_token, then device_name + role)
+still holds, and that the one-time dedupe keeps a role only an older row had.
+Database setup and teardown come from script_harness.
+Run manually: MONGO_URL=mongodb://... python test_device_registration.py
+"""
+import asyncio
+
+from script_harness import check, run
+
+import server
+from server import DeviceCreate, register_device
+
+PARALLEL = 50
+
+
+async def register_all(bodies):
+    """Results of parallel registrations; a 409 (gave up after duplicate-key races) comes back as the exception"""
+    return await asyncio.gather(*[register_device(b) for b in bodies], return_exceptions=True)
+
+
+def check_no_errors(results):
+    errors = [r for r in results if isinstance(r, Exception)]
+    return check(f"no registration failed ({len(errors)} error(s): {sorted({str(e) for e in errors})})", not errors)
+
+
+async def same_device_id():
+    body = DeviceCreate(device_id="tablet-1", device_name="Kasir 1", role="STORE_TABLET", fcm_token="tok-1")
+    results = await register_all([body] * PARALLEL)
+    count = await server.db.devices.count_documents({"device_id": "tablet-1"})
+    ok = check_no_errors(results)
+    return check(f"{PARALLEL} parallel launches of one device -> {count} row(s)", count == 1) and ok
+
+
+async def reinstall_storm():
+    # Every reinstall gets a new device_id but FCM hands back the same token
+    bodies = [DeviceCreate(device_id=f"reinstall-{i}", device_name="Owner HP", role="OWNER", fcm_token="tok-owner")
+              for i in range(PARALLEL)]
+    results = await register_all(bodies)
+    count = await server.db.devices.count_documents({"fcm_token": "tok-owner"})
+    ok = check_no_errors(results)
+    return check(f"{PARALLEL} parallel reinstalls sharing a token -> {count} row(s)", count == 1) and ok
+
+
+async def mixed_fleet():
+    bodies = [DeviceCreate(device_id=f"fleet-{i % 10}", device_name=f"Tablet {i % 10}", role="STORE_TABLET",
+                           fcm_token=f"tok-fleet-{i % 10}") for i in range(PARALLEL * 2)]
+    results = await register_all(bodies)
+    count = await server.db.devices.count_documents({"device_id": {"$regex": "^fleet-"}})
+    ok = check_no_errors(results)
+    ok = check(f"10 devices launching {PARALLEL * 2} times in parallel -> {count} row(s)", count == 10) and ok
+    return check("every call returned its device", all(not isinstance(r, Exception) and r["device_id"] == b.device_id
+                                                       for r, b in zip(results, bodies))) and ok
+
+
+async def precedence():
+    await server.db.devices.insert_one({"id": "row-kasir", "device_id": "kasir-old", "device_name": "Kasir 2",
+                                        "role": "STORE_TABLET", "fcm_token": "tok-kasir", "created_at": "2024-01-01"})
+    await server.db.devices.insert_one({"id": "row-gudang", "device_id": "gudang-old", "device_name": "Gudang",
+                                        "role": "WAREHOUSE", "fcm_token": "tok-gudang-old", "created_at": "2024-01-01"})
+    known = await register_device(DeviceCreate(device_id="kasir-old", device_name="Kasir 2", role="NONE"))
+    token = await register_device(DeviceCreate(device_id="kasir-new", device_name="Kasir 2b", role="NONE",
+                                               fcm_token="tok-kasir"))
+    name = await register_device(DeviceCreate(device_id="gudang-new", device_name="Gudang", role="WAREHOUSE"))
+    gudang = await server.db.devices.find({"device_name": "Gudang"}, {"_id": 0}).to_list(None)
+    return all([
+        check("known device_id keeps its role", known["role"] == "STORE_TABLET"),
+        check("reinstall with the same token rebinds that row", token["id"] == "row-kasir"
+              and token["role"] == "STORE_TABLET" and token["device_id"] == "kasir-new"),
+        check("reinstall without a token match takes over the name + role row",
+              name["id"] == "row-gudang" and [d["device_id"] for d in gudang] == ["gudang-new"]),
+    ])
+
+
+async def dedupe_keeps_role():
+    await server.db.devices.insert_many([
+        {"id": "dup-a", "device_id": "dup", "device_name": "Owner HP", "role": "OWNER", "last_active": "2024-01-01"},
+        {"id": "dup-b", "device_id": "dup", "device_name": "", "role": "NONE", "last_active": "2024-06-01"},
+    ])
+    await server.dedupe_devices()
+    rows = await server.db.devices.find({"device_id": "dup"}, {"_id": 0}).to_list(None)
+    merged = len(rows) == 1 and rows[0]["id"] == "dup-b" and rows[0]["role"] == "OWNER" \
+        and rows[0]["device_name"] == "Owner HP"
+    await server.db.devices.insert_one({"id": "dup-c", "device_id": "dup", "role": "NONE", "last_active": "2025-01-01"})
+    await server.dedupe_devices()
+    once = await server.db.devices.count_documents({"device_id": "dup"}) == 2
+    await server.db.devices.delete_many({"device_id": "dup"})
+    return all([
+        check("dedupe keeps the role and name only an older row had", merged),
+        check("dedupe runs once", once),
+    ])
+
+
+async def main():
+    deduped = await dedupe_keeps_role()
+    await server.db.devices.create_indexes(server.INDEXES["devices"])
+    return all([deduped, await same_device_id(), await reinstall_storm(), await mixed_fleet(), await precedence()])
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,246 @@
+"""Test batched FCM fan-out against a local stub of firebase_admin.messaging
+
+No Firebase project needed: the stub records every send_each call and sleeps
+like a slow HTTPS round trip, so we can check the batching, the per-role
+metrics, how failed tokens are split into retry / dead, and that the event
+loop keeps running while pushes go out. The outbox checks (claim, lease
+re-claim, sent / pending / failed transitions, dead-token pruning, re-queue
+while Firebase is unavailable) run against the throwaway MongoDB database
+that script_harness sets up.
+Run manually: MONGO_URL=mongodb://... python test_notifications.py
+"""
+import sys
+import time
+import uuid
+import types
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from script_harness import check, check_all, run
+
+SEND_DELAY = 0.2
+calls = []
+
+
+class Notification:
+    def __init__(self, title=None, body=None):
+        self.title, self.body = title, body
+
+
+class Message:
+    def __init__(self, notification=None, data=None, token=None):
+        self.notification, self.data, self.token = notification, data, token
+
+
+class UnregisteredError(Exception):
+    pass
+
+
+class SenderIdMismatchError(Exception):
+    pass
+
+
+class SendResponse:
+    def __init__(self, token):
+        self.success = not token.startswith(("dead", "flaky"))
+        self.exception = None
+        if token.startswith("dead"):
+            self.exception = UnregisteredError("Requested entity was not found.")
+        elif token.startswith("flaky"):
+            self.exception = Exception("Service unavailable")
+
+
+class BatchResponse:
+    def __init__(self, responses):
+        self.responses = responses
+
+
+def send_each(messages):
+    calls.append(len(messages))
+    time.sleep(SEND_DELAY)  # blocking, like the real HTTPS call
+    return BatchResponse([SendResponse(m.token) for m in messages])
+
+
+messaging = types.ModuleType("firebase_admin.messaging")
+messaging.Notification, messaging.Message, messaging.send_each = Notification, Message, send_each
+messaging.UnregisteredError, messaging.SenderIdMismatchError = UnregisteredError, SenderIdMismatchError
+credentials = types.ModuleType("firebase_admin.credentials")
+credentials.Certificate = lambda *a, **k: None
+firebase_admin = types.ModuleType("firebase_admin")
+firebase_admin.messaging, firebase_admin.credentials = messaging, credentials
+firebase_admin.initialize_app = lambda *a, **k: None
+
+
+def get_app():
+    raise ValueError("The default Firebase app does not exist.")
+
+
+firebase_admin.get_app = get_app
+sys.modules.update({"firebase_admin": firebase_admin, "firebase_admin.messaging": messaging,
+                    "firebase_admin.credentials": credentials})
+
+import server  # noqa: E402  (after the firebase_admin stub)
+
+
+async def ticker(stop):
+    ticks = 0
+    while not stop.is_set():
+        await asyncio.sleep(0.01)
+        ticks += 1
+    return ticks
+
+
+def check_lazy_init():
+    ok = check_all([
+        ("firebase not loaded on import", server.messaging is None and server.firebase_status["state"] == "idle"),
+        ("JSON credentials parsed", server.parse_firebase_credentials('{"type": "service_account"}')
+         == {"type": "service_account"}),
+        ("initialized on demand", server.init_firebase() and server.messaging is messaging),
+        ("import time recorded", "firebase_admin" in server.import_timings),
+    ])
+    return ok
+
+
+async def check_fan_out():
+    tokens = [f"token-{i}" for i in range(1192)] + [f"dead-{i}" for i in range(5)] + [f"flaky-{i}" for i in range(3)]
+
+    stop = asyncio.Event()
+    tick_task = asyncio.create_task(ticker(stop))
+    result = await server.deliver("STORE_TABLET", tokens, "Kasbon Disetujui", "Test", {"type": "test"}, skipped=1)
+    stop.set()
+    ticks = await tick_task
+
+    stats = server.notification_stats["STORE_TABLET"]
+    return check_all([
+        ("batches of at most 500", calls == [500, 500, 200]),
+        ("1192 sent", stats["sent"] == 1192),
+        ("8 failed", stats["failed"] == 8),
+        ("1 without token", stats["no_token"] == 1),
+        ("unregistered tokens marked dead", result["dead"] == [f"dead-{i}" for i in range(5)]),
+        ("transient failures kept for retry", result["retry"] == [f"flaky-{i}" for i in range(3)]),
+        ("latency recorded", stats["last_latency_ms"] >= SEND_DELAY * 3 * 1000),
+        ("failure recorded", bool(stats["last_error"])),
+        # 3 x 0.2 s of blocking sends; a blocked loop would barely tick
+        ("event loop kept running", ticks > 30),
+    ])
+
+
+async def check_retry_backoff():
+    delays = [server.retry_delay(n) for n in range(1, 12)]
+    passed = (delays[0] == server.NOTIFY_RETRY_BASE_SECONDS and delays[1] == 2 * delays[0]
+              and all(a <= b for a, b in zip(delays, delays[1:])) and delays[-1] == server.NOTIFY_RETRY_MAX_SECONDS)
+    return check(f"exponential backoff capped at {server.NOTIFY_RETRY_MAX_SECONDS:.0f} s", passed)
+
+
+async def outbox_entry(**fields):
+    now = datetime.now(timezone.utc)
+    entry = {"id": str(uuid.uuid4()), "role": "OWNER", "title": "Kasbon Baru", "body": "Test", "data": {},
+             "status": "pending", "attempts": 0, "tokens": None, "last_error": None,
+             "created_at": now, "next_attempt_at": now, **fields}
+    await server.db.notification_outbox.insert_one(entry)
+    return entry["id"]
+
+
+async def outbox_row(entry_id):
+    return await server.db.notification_outbox.find_one({"id": entry_id})
+
+
+async def check_outbox_delivery():
+    await server.db.devices.insert_many([
+        {"device_id": "owner-phone", "role": "OWNER", "fcm_token": "owner-ok"},
+        {"device_id": "owner-old", "role": "OWNER", "fcm_token": "dead-owner"},
+        {"device_id": "owner-tablet", "role": "OWNER", "fcm_token": "flaky-owner"},
+        {"device_id": "owner-web", "role": "OWNER"},
+    ])
+    queued = await server.send_notification_to_role("OWNER", "Kasbon Baru", "Test", {"type": "kasbon"})
+    entry = await server.claim_outbox_entry()
+    claimed = entry is not None and entry["status"] == "sending" and bool(entry.get("lease_until"))
+    await server.process_outbox_entry(entry)
+    row = await outbox_row(entry["id"])
+    old_device = await server.db.devices.find_one({"device_id": "owner-old"})
+    results = check_all([
+        ("queued as pending", queued),
+        ("claimed with a lease", claimed),
+        ("transient failure -> pending with backoff",
+         row["status"] == "pending" and row["attempts"] == 1 and "lease_until" not in row
+         and row["next_attempt_at"] > row["last_attempt_at"]),
+        ("only the failed token kept for retry", row["tokens"] == ["flaky-owner"]),
+        ("unregistered token pruned from devices", "fcm_token" not in old_device),
+        ("not claimed again before backoff", await server.claim_outbox_entry() is None),
+    ])
+
+    # Backoff elapsed and the device recovered
+    await server.db.notification_outbox.update_one(
+        {"id": entry["id"]}, {"$set": {"next_attempt_at": datetime.now(timezone.utc), "tokens": ["owner-ok"]}})
+    await server.process_outbox_entry(await server.claim_outbox_entry())
+    row = await outbox_row(entry["id"])
+    return results and check_all([
+        ("retry delivered -> sent", row["status"] == "sent" and row["attempts"] == 2 and row["tokens"] == []),
+        ("finished entry expires", bool(row.get("expires_at"))),
+    ])
+
+
+async def check_outbox_lease():
+    now = datetime.now(timezone.utc)
+    live = await outbox_entry(status="sending", lease_until=now + timedelta(minutes=5))
+    stale = await outbox_entry(status="sending", lease_until=now - timedelta(seconds=1))
+    entry = await server.claim_outbox_entry()
+    reclaimed = entry is not None and entry["id"] == stale
+    nothing_left = await server.claim_outbox_entry() is None
+    await server.db.notification_outbox.delete_many({"id": {"$in": [live, stale]}})
+    return check_all([
+        ("expired lease re-claimed", reclaimed),
+        ("live lease left alone", nothing_left),
+    ])
+
+
+async def check_outbox_give_up():
+    entry_id = await outbox_entry(attempts=server.NOTIFY_MAX_ATTEMPTS - 1, tokens=["flaky-owner"])
+    await server.process_outbox_entry(await server.claim_outbox_entry())
+    row = await outbox_row(entry_id)
+    return check_all([
+        ("last attempt failed -> failed", row["status"] == "failed"
+         and row["attempts"] == server.NOTIFY_MAX_ATTEMPTS and row["tokens"] == ["flaky-owner"]),
+        ("failure reason kept", bool(row["last_error"])),
+    ])
+
+
+async def check_firebase_unavailable():
+    entry_id = await outbox_entry()
+    server.firebase_status.update({"state": "failed", "error": "credentials missing"})
+    server._firebase_retry_at = time.monotonic() + 60
+    await server.process_outbox_entry(await server.claim_outbox_entry())
+    row = await outbox_row(entry_id)
+    results = check_all([
+        ("firebase down -> re-queued without spending an attempt",
+         row["status"] == "pending" and row["attempts"] == 0 and row["tokens"] is None
+         and row["next_attempt_at"] > row["created_at"] + timedelta(seconds=30)),
+        ("no re-init before the cooldown", not server.init_firebase()),
+    ])
+    server._firebase_retry_at = time.monotonic()
+    return results and check_all([("re-initialized after the cooldown", await server.ensure_firebase())])
+
+
+async def check_enqueue_failure():
+    async def broken_insert(*args, **kwargs):
+        raise RuntimeError("connection reset")
+
+    db = server.db
+    server.db = types.SimpleNamespace(notification_outbox=types.SimpleNamespace(insert_one=broken_insert))
+    try:
+        queued = await server.send_notification_to_role("OWNER", "Kasbon Lunas", "Test")
+    except Exception:
+        queued = None
+    finally:
+        server.db = db
+    return check_all([("outbox insert failure logged, not raised", queued is False)])
+
+
+async def main():
+    return all([check_lazy_init(), await check_fan_out(), await check_retry_backoff(),
+                await check_outbox_delivery(), await check_outbox_lease(), await check_outbox_give_up(),
+                await check_firebase_unavailable(), await check_enqueue_failure()])
+
+
+if __name__ == "__main__":
+    run(main)
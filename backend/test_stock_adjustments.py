@@ -0,0 +1,56 @@
+"""Test guarded stock adjustments against a real MongoDB
+
+Checks the oversell guard in adjust_stock: a job whose materials are all in
+stock is applied in one bulk_write, a job with a short item is refused with
+StockShortage naming only that item, and the decrements that did apply are
+put back. Database setup and teardown come from script_harness.
+Run manually: MONGO_URL=mongodb://... python test_stock_adjustments.py
+"""
+from script_harness import check, run
+
+import server
+
+
+async def quantities():
+    return {d["id"]: d["quantity"] async for d in server.db.stock.find({}, {"_id": 0, "id": 1, "quantity": 1})}
+
+
+async def check_in_stock():
+    await server.adjust_stock({"vinyl": -4, "banner": -2, "deleted-item": -1})
+    q = await quantities()
+    return check("all in stock -> applied, missing stock item skipped", q == {"vinyl": 6, "banner": 0, "sticker": 5})
+
+
+async def check_shortage_and_undo():
+    try:
+        await server.adjust_stock({"vinyl": -5, "banner": -1, "sticker": -5})
+        shortage = None
+    except server.StockShortage as e:
+        shortage = e
+    q = await quantities()
+    ok = check("short item refused", shortage is not None and shortage.stock_ids == ["banner"])
+    ok = check("applied decrements put back", q == {"vinyl": 6, "banner": 0, "sticker": 5}) and ok
+    held = await server.db.stock.count_documents({"stock_holds.0": {"$exists": True}, "id": {"$in": ["sticker"]}})
+    ok = check("undone rows carry no hold from the refused call", held == 0) and ok
+    response = await server.stock_shortage_response(shortage, {"vinyl": -5, "banner": -1, "sticker": -5})
+    return check("409 lists the failed material", response.status_code == 409
+                 and b'"stock_id":"banner"' in response.body.replace(b" ", b"")) and ok
+
+
+async def check_increments():
+    await server.adjust_stock({"vinyl": 4, "banner": 2})
+    q = await quantities()
+    return check("returned stock is added back", q == {"vinyl": 10, "banner": 2, "sticker": 5})
+
+
+async def main():
+    await server.db.stock.insert_many([
+        {"id": "vinyl", "name": "Vinyl", "quantity": 10},
+        {"id": "banner", "name": "Banner 280gr", "quantity": 2},
+        {"id": "sticker", "name": "Sticker Chromo", "quantity": 5},
+    ])
+    return all([await check_in_stock(), await check_shortage_and_undo(), await check_increments()])
+
+
+if __name__ == "__main__":
+    run(main)